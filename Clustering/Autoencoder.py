@@ -9,7 +9,6 @@ from sklearn.cluster import KMeans
 from sklearn.metrics import normalized_mutual_info_score as nmi, adjusted_rand_score as ari
 from scipy.optimize import linear_sum_assignment as linear_assignment
 from sklearn.metrics import confusion_matrix
-import seaborn as sns
 import matplotlib.pyplot as plt
 
 
@@ -25,14 +24,10 @@ def acc_cluster(y_true, y_pred):
     y_true = y_true.astype(np.int64)
     assert y_pred.size == y_true.size
     D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
+    w = np.bincount(y_pred.astype(np.int64) * D + y_true, minlength=D * D).reshape(D, D)
 
     ind = linear_assignment(w.max() - w)
-    s = 0
-    for i, j in zip(ind[0], ind[1]):
-        s += w[i, j]
+    s = int(w[ind[0], ind[1]].sum())
     return s * 1.0 / y_pred.size
 
 
@@ -116,9 +111,14 @@ class ClusteringLayer(Layer):
         Return:
             q: student's t-distribution, or soft labels for each sample. shape=(n_samples, n_clusters)
         """
-        q = 1.0 / (1.0 + (K.sum(K.square(K.expand_dims(inputs, axis=1) - self.clusters), axis=2) / self.alpha))
+        # ||x - µ||^2 = ||x||^2 + ||µ||^2 - 2 x·µ, avoids the (n_samples, n_clusters, n_features) difference tensor
+        x2 = K.sum(K.square(inputs), axis=1, keepdims=True)
+        c2 = K.sum(K.square(self.clusters), axis=1)
+        xc = K.dot(inputs, K.transpose(self.clusters))
+        dist2 = K.maximum(x2 + c2 - 2.0 * xc, 0.0)  # clip the small negative values due to rounding
+        q = 1.0 / (1.0 + (dist2 / self.alpha))
         q **= (self.alpha + 1.0) / 2.0
-        q = K.transpose(K.transpose(q) / K.sum(q, axis=1)) # Make sure each sample's 10 values add up to 1.
+        q = q / K.sum(q, axis=1, keepdims=True)  # Make sure each sample's 10 values add up to 1.
         return q
 
     def compute_output_shape(self, input_shape):
@@ -132,8 +132,8 @@ class ClusteringLayer(Layer):
 
 
 def target_distribution(q):
-    weight = q ** 2 / q.sum(0)
-    return (weight.T / weight.sum(1)).T
+    weight = q ** 2 / q.sum(0, keepdims=True)
+    return weight / weight.sum(1, keepdims=True)
 
 
 if __name__ == "__main__":
@@ -191,10 +191,10 @@ if __name__ == "__main__":
 
     if train_cluster:
         loss = 0
-        index = 0
         maxiter = 8000
         update_interval = 140
         index_array = np.arange(X.shape[0])
+        batches_per_epoch = (X.shape[0] + batch_size - 1) // batch_size
         tol = 0.001  # tolerance threshold to stop training
 
         for ite in range(int(maxiter)):
@@ -216,15 +216,18 @@ if __name__ == "__main__":
                     print('Iter %d: acc = %.5f, nmi = %.5f, ari = %.5f' % (ite, acc_v, nmi_v, ari_v), ' ; loss=', loss)
 
                 # check stop criterion - model convergence
-                delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
-                y_pred_last = np.copy(y_pred)
+                delta_label = np.count_nonzero(y_pred != y_pred_last) / y_pred.size
+                y_pred_last = y_pred  # argmax returns a new array at every update, no need to copy
                 if ite > 0 and delta_label < tol:
                     print('delta_label ', delta_label, '< tol ', tol)
                     print('Reached tolerance threshold. Stopping training.')
                     break
-            idx = index_array[index * batch_size: min((index + 1) * batch_size, X.shape[0])]
+            # reshuffle at the start of every epoch, each epoch covers all the samples once
+            index = ite % batches_per_epoch
+            if index == 0:
+                np.random.shuffle(index_array)
+            idx = index_array[index * batch_size:(index + 1) * batch_size]
             loss = model.train_on_batch(x=X[idx], y=p[idx])
-            index = index + 1 if (index + 1) * batch_size <= X.shape[0] else 0
 
         # model.save("..\\Models\\ViT-unsupervised\\DEC_model_final.h5")
 
@@ -244,11 +247,17 @@ if __name__ == "__main__":
         loss = np.round(loss, 5)
         print('Acc = %.5f, nmi = %.5f, ari = %.5f' % (acc_v, nmi_v, ari_v), ' ; loss=', loss)
 
-    sns.set(font_scale=3)
     confusion_matrix = confusion_matrix(y_test, y_pred)
 
     plt.figure(figsize=(16, 14))
-    sns.heatmap(confusion_matrix, annot=True, fmt="d", annot_kws={"size": 20});
+    plt.imshow(confusion_matrix, cmap='Blues')
+    plt.colorbar()
+    for (i, j), v in np.ndenumerate(confusion_matrix):
+        # white on the dark cells, as sns.heatmap did, so the matched diagonal stays readable
+        plt.text(j, i, str(v), ha='center', va='center', fontsize=20,
+                 color='white' if v > confusion_matrix.max() / 2 else 'black')
+    plt.xticks(fontsize=33)  # same size as the old sns.set(font_scale=3) ticks
+    plt.yticks(fontsize=33)
     # Here you can quickly match the clustering assignment by hand, e.g., cluster 1 matches with true label 7 or handwritten digit "7" and vise visa.
     plt.title("Confusion matrix", fontsize=30)
     plt.ylabel('True label', fontsize=25)
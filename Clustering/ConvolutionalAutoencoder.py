@@ -1,14 +1,17 @@
+import os
 import numpy as np
+import tensorflow as tf
 import tensorflow.keras.backend as K
 from tensorflow.keras.layers import Layer, InputSpec
-from tensorflow.keras.layers import Dense, Input, Conv2D, MaxPooling2D, UpSampling2D, Flatten, Reshape
+from tensorflow.keras.layers import Dense, Input, Conv2D, Conv2DTranspose, MaxPooling2D, Flatten, Reshape
 from tensorflow.keras.models import Model, load_model
+from tensorflow.keras import mixed_precision
 from tensorflow.keras.initializers import VarianceScaling
 from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
 from sklearn.metrics import normalized_mutual_info_score as nmi, adjusted_rand_score as ari
 from scipy.optimize import linear_sum_assignment as linear_assignment
 from sklearn.metrics import confusion_matrix, classification_report
-import seaborn as sns
 import matplotlib.pyplot as plt
 
 
@@ -24,17 +27,32 @@ def acc_cluster(y_true, y_pred):
     y_true = y_true.astype(np.int64)
     assert y_pred.size == y_true.size
     D = max(y_pred.max(), y_true.max()) + 1
-    w = np.zeros((D, D), dtype=np.int64)
-    for i in range(y_pred.size):
-        w[y_pred[i], y_true[i]] += 1
+    w = np.bincount(y_pred.astype(np.int64) * D + y_true, minlength=D * D).reshape(D, D)
 
     ind = linear_assignment(w.max() - w)
-    s = 0
-    for i, j in zip(ind[0], ind[1]):
-        s += w[i, j]
+    s = int(w[ind[0], ind[1]].sum())
     return s * 1.0 / y_pred.size
 
 
+def fit_kmeans(x, n_clusters, seed):
+    return KMeans(n_clusters=n_clusters, init='k-means++', n_init=1, random_state=seed).fit(x)
+
+
+def parallel_kmeans(x, n_clusters, n_init=4, n_jobs=-1):
+    """
+    Run the k-means restarts in parallel processes instead of sequentially inside a single KMeans call.
+    # Arguments
+        x: data to cluster, numpy.array with shape `(n_samples, n_features)`
+        n_clusters: number of clusters
+        n_init: number of k-means++ initializations, each one runs in its own job
+        n_jobs: number of parallel jobs, -1 uses all the cores
+    # Return
+        the fitted KMeans with the lowest inertia
+    """
+    results = Parallel(n_jobs=n_jobs)(delayed(fit_kmeans)(x, n_clusters, seed) for seed in range(n_init))
+    return min(results, key=lambda k: k.inertia_)
+
+
 def conv_autoencoder(act='relu', init='glorot_uniform'):
 
     input_img = Input(shape=(224, 224, 3))
@@ -46,18 +64,16 @@ def conv_autoencoder(act='relu', init='glorot_uniform'):
     x = Conv2D(8, (3, 3), activation='relu', padding='same')(x)
     x = MaxPooling2D((2, 2), padding='same')(x)
     x = Flatten()(x)
-    encoded = Dense(10, activation='relu', name='encoded')(x)
+    encoded = Dense(10, activation='relu', name='encoded', dtype='float32')(x)
 
     # at this point the representation is (4, 4, 8) i.e. 128-dimensional
     x = Dense(28*28*8)(encoded)
     x = Reshape((28, 28, 8))(x)
-    x = Conv2D(8, (3, 3), activation='relu', padding='same')(x)
-    x = UpSampling2D((2, 2))(x)
-    x = Conv2D(8, (3, 3), activation='relu', padding='same')(x)
-    x = UpSampling2D((2, 2))(x)
-    x = Conv2D(16, (3, 3), activation='relu', padding='same')(x)
-    x = UpSampling2D((2, 2))(x)
-    decoded = Conv2D(3, (3, 3), activation='sigmoid', padding='same')(x)
+    # strided transposed convolutions upsample and convolve in one pass, without the 4x larger UpSampling2D maps
+    x = Conv2DTranspose(8, (3, 3), strides=2, activation='relu', padding='same')(x)
+    x = Conv2DTranspose(8, (3, 3), strides=2, activation='relu', padding='same')(x)
+    x = Conv2DTranspose(16, (3, 3), strides=2, activation='relu', padding='same')(x)
+    decoded = Conv2D(3, (3, 3), activation='sigmoid', padding='same', dtype='float32')(x)  # float32 output for a stable mse
 
     return Model(inputs=input_img, outputs=decoded, name='AE'), Model(inputs=input_img, outputs=encoded, name='encoder')
 
@@ -110,9 +126,14 @@ class ClusteringLayer(Layer):
         Return:
             q: student's t-distribution, or soft labels for each sample. shape=(n_samples, n_clusters)
         """
-        q = 1.0 / (1.0 + (K.sum(K.square(K.expand_dims(inputs, axis=1) - self.clusters), axis=2) / self.alpha))
+        # ||x - µ||^2 = ||x||^2 + ||µ||^2 - 2 x·µ, avoids the (n_samples, n_clusters, n_features) difference tensor
+        x2 = K.sum(K.square(inputs), axis=1, keepdims=True)
+        c2 = K.sum(K.square(self.clusters), axis=1)
+        xc = K.dot(inputs, K.transpose(self.clusters))
+        dist2 = K.maximum(x2 + c2 - 2.0 * xc, 0.0)  # clip the small negative values due to rounding
+        q = 1.0 / (1.0 + (dist2 / self.alpha))
         q **= (self.alpha + 1.0) / 2.0
-        q = K.transpose(K.transpose(q) / K.sum(q, axis=1)) # Make sure each sample's 10 values add up to 1.
+        q = q / K.sum(q, axis=1, keepdims=True)  # Make sure each sample's 10 values add up to 1.
         return q
 
     def compute_output_shape(self, input_shape):
@@ -125,9 +146,75 @@ class ClusteringLayer(Layer):
         return dict(list(base_config.items()) + list(config.items()))
 
 
+def load_images(path):
+    """
+    Load an image array saved with np.savez_compressed as a read-only memory map.
+    The arrays in a .npz archive cannot be memory mapped, so the array is extracted to a .npy file next to the
+    archive, i.e. a full uncompressed copy of the dataset on disk. The copy is rebuilt whenever the archive is newer,
+    e.g. after ExtractVectorFromImages regenerated it.
+    # Arguments
+        path: path of the .npz archive
+    # Return
+        numpy.memmap with the images
+    """
+    npy_path = os.path.splitext(path)[0] + ".npy"
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(path):
+        np.save(npy_path, np.load(path)['arr_0'])
+    return np.load(npy_path, mmap_mode='r')
+
+
+def image_dataset(x, batch_size, shuffle=False):
+    """
+    Stream a (memory mapped) image array in batches. Unlike from_tensor_slices the array is never copied whole
+    into a tf.Tensor, only the pages of the current batch are read from disk.
+    Images not already stored as float32 are cast once here (uint8 ones are also rescaled to [0, 1]), so keras does
+    not cast them again at every step.
+    # Arguments
+        x: numpy.array or numpy.memmap with shape `(n_samples, height, width, channels)`
+        batch_size: number of images per batch
+        shuffle: draw the batches from a new permutation of the samples at every epoch
+    # Return
+        batched tf.data.Dataset of float32 images
+    """
+    def generator():
+        if shuffle:
+            index_array = np.random.permutation(x.shape[0])
+            for i in range(0, x.shape[0], batch_size):
+                yield x[np.sort(index_array[i:i + batch_size])]
+        else:
+            for i in range(0, x.shape[0], batch_size):
+                yield x[i:i + batch_size]
+
+    signature = tf.TensorSpec(shape=(None,) + x.shape[1:], dtype=tf.as_dtype(x.dtype))
+    dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+    if x.dtype != np.float32:
+        scale = 1.0 / 255.0 if x.dtype == np.uint8 else 1.0
+        dataset = dataset.map(lambda batch: tf.cast(batch, tf.float32) * scale, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def predict_batched(predict_fn, dataset):
+    """
+    Run a compiled forward pass over every batch of a tf.data dataset.
+    # Arguments
+        predict_fn: tf.function wrapping the model call
+        dataset: batched tf.data.Dataset of inputs
+    # Return
+        tf.Tensor with the outputs of all the batches concatenated along axis 0
+    """
+    return tf.concat([predict_fn(batch) for batch in dataset], axis=0)
+
+
 def target_distribution(q):
-    weight = q ** 2 / q.sum(0)
-    return (weight.T / weight.sum(1)).T
+    weight = q ** 2 / q.sum(0, keepdims=True)
+    return weight / weight.sum(1, keepdims=True)
+
+
+@tf.function(jit_compile=True)
+def target_distribution_tf(q):
+    """ Same as target_distribution, fused in a single XLA kernel and kept on the device. """
+    weight = tf.square(q) / tf.reduce_sum(q, axis=0, keepdims=True)
+    return weight / tf.reduce_sum(weight, axis=1, keepdims=True)
 
 
 if __name__ == "__main__":
@@ -135,13 +222,15 @@ if __name__ == "__main__":
     pretrain_autoencoder = True
     train_cluster = True
 
-    X_dict = np.load("..\\NumpyData\\X_convae.npz")
-    X = X_dict['arr_0']
+    # conv layers compute in float16, weights and the encoded / decoded outputs stay in float32
+    mixed_precision.set_global_policy('mixed_float16')
+    tf.keras.utils.set_random_seed(0)
+
+    X = load_images("..\\NumpyData\\X_convae.npz")
     y_dict = np.load("..\\NumpyData\\y_convae.npz")
     y = y_dict['arr_0']
 
-    X_dict_test = np.load("..\\NumpyData\\X_test_convae.npz")
-    X_test = X_dict_test['arr_0']
+    X_test = load_images("..\\NumpyData\\X_test_convae.npz")
     y_dict_test = np.load("..\\NumpyData\\y_test_convae.npz")
     y_test = y_dict_test['arr_0']
 
@@ -150,48 +239,88 @@ if __name__ == "__main__":
     dims = [X.shape[-1], 500, 500, 2000, 10]
     # Generalization of Xavier inizialization
     init = VarianceScaling(scale=1. / 3., mode='fan_in', distribution='uniform')
-    pretrain_epochs = 200
+    pretrain_epochs = 40
     batch_size = 128
 
     autoencoder, encoder = conv_autoencoder()
 
     autoencoder.summary()
     encoder.summary()
-    autoencoder.compile(optimizer='adadelta', loss='mse')
+    autoencoder.compile(optimizer=tf.keras.optimizers.AdamW(1e-3), loss='mse', jit_compile=True)
+    cb = [tf.keras.callbacks.EarlyStopping(monitor='loss', patience=5, min_delta=1e-5)]
 
     if pretrain_autoencoder:
-        autoencoder.fit(X, X, batch_size=batch_size, epochs=pretrain_epochs)  # , callbacks=cb)
+        ds_ae = image_dataset(X, batch_size, shuffle=True).map(lambda x: (x, x), num_parallel_calls=tf.data.AUTOTUNE)
+        autoencoder.fit(ds_ae, epochs=pretrain_epochs, callbacks=cb)
         autoencoder.save("..\\Models\\ViT-unsupervised\\conv_ae_weights.h5")
         encoder.save("..\\Models\\ViT-unsupervised\\conv_e_weights.h5")
     else:
         autoencoder = load_model("..\\Models\\ViT-unsupervised\\conv_ae_weights.h5")
         encoder = load_model("..\\Models\\ViT-unsupervised\\conv_e_weights_cnn.h5")
 
-    clustering_layer = ClusteringLayer(n_clusters, name='clustering')(encoder.output)
-    model = Model(inputs=encoder.input, outputs=clustering_layer)
-    model.compile(optimizer='adam', loss='kld')
+    # DEC only trains the clustering layer, the pretrained encoder is frozen
+    for layer in encoder.layers:
+        layer.trainable = False
+
+    clustering_layer = ClusteringLayer(n_clusters, name='clustering', dtype='float32')
+    model = Model(inputs=encoder.input, outputs=clustering_layer(encoder.output))
+    # only saved below, the clustering layer is already fused by XLA in train_step and head_fn
+    model.compile(optimizer='adam', loss='kld', jit_compile=True)
+
+    # clustering head alone, shares the clustering layer with model and is trained on the encoded vectors
+    head_input = Input(shape=(encoder.output_shape[-1],))
+    head = Model(inputs=head_input, outputs=clustering_layer(head_input), name='head')
+
+    # compile the forward passes once, model.predict re-builds the data adapter at every call
+    encoder_fn = tf.function(lambda x: encoder(x, training=False), jit_compile=True)
+    head_fn = tf.function(lambda z: head(z, training=False), jit_compile=True)
+    kld = tf.keras.losses.KLDivergence()
+    # plain Adam built outside compile, so the mixed_float16 policy does not wrap it in a LossScaleOptimizer:
+    # the head is float32 and its loss is never scaled
+    head_optimizer = tf.keras.optimizers.Adam()
+
+    @tf.function(jit_compile=True)
+    def train_step(idx):
+        # same update as head.train_on_batch, without the per call python overhead of keras.
+        # the mini-batch is gathered on the device from Z_tf and p_tf, no host to device copy per step
+        zb = tf.gather(Z_tf, idx)
+        pb = tf.gather(p_tf, idx)
+        with tf.GradientTape() as tape:
+            loss = kld(pb, head(zb, training=True))
+        grads = tape.gradient(loss, head.trainable_weights)
+        head_optimizer.apply_gradients(zip(grads, head.trainable_weights))
+        return loss
+
+    ds = image_dataset(X, batch_size)
+    ds_test = image_dataset(X_test, batch_size)
+
+    # the encoder is not updated by DEC, so X is encoded only once and the conv layers stay out of the loop
+    Z_tf = predict_batched(encoder_fn, ds)
+    Z = Z_tf.numpy()
+    p_tf = tf.Variable(tf.zeros((Z.shape[0], n_clusters), dtype=tf.float32), trainable=False)
 
     # inizializza i centri del cluster a quelli del kmeans.
-    kmeans = KMeans(n_clusters=n_clusters, n_init=20)
-    y_pred = kmeans.fit_predict(encoder.predict(X))
+    # a few k-means++ runs are enough, DEC refines the centers right after
+    kmeans = parallel_kmeans(Z, n_clusters)
+    y_pred = kmeans.labels_
     y_pred_last = np.copy(y_pred)
     model.get_layer(name='clustering').set_weights([kmeans.cluster_centers_])
 
     if train_cluster:
         loss = 0
-        index = 0
         maxiter = 8000
         update_interval = 140
         index_array = np.arange(X.shape[0])
+        batches_per_epoch = (X.shape[0] + batch_size - 1) // batch_size
         tol = 0.001  # tolerance threshold to stop training
 
         for ite in range(int(maxiter)):
             if ite % update_interval == 0:
-                q = model.predict(X, verbose=0)
-                p = target_distribution(q)  # update the auxiliary target distribution p
+                q = head_fn(Z_tf)
+                p_tf.assign(target_distribution_tf(q))  # update the auxiliary target distribution p
 
                 # evaluate the clustering performance
-                y_pred = q.argmax(1)
+                y_pred = tf.math.argmax(q, axis=1, output_type=tf.int32).numpy()
 
                 # if ite == 0:
                 #     y_pred_last = np.copy(y_pred)
@@ -200,50 +329,65 @@ if __name__ == "__main__":
                     acc_v = np.round(acc_cluster(y, y_pred), 5)
                     nmi_v = np.round(nmi(y, y_pred), 5)
                     ari_v = np.round(ari(y, y_pred), 5)
-                    loss = np.round(loss, 10)
+                    loss = np.round(float(loss), 10)
                     print('Iter %d: acc = %.5f, nmi = %.5f, ari = %.5f' % (ite, acc_v, nmi_v, ari_v), ' ; loss=', loss)
 
                 # check stop criterion - model convergence
-                delta_label = np.sum(y_pred != y_pred_last).astype(np.float32) / y_pred.shape[0]
-                y_pred_last = np.copy(y_pred)
+                delta_label = np.count_nonzero(y_pred != y_pred_last) / y_pred.size
+                y_pred_last = y_pred  # argmax returns a new array at every update, no need to copy
                 if ite > 0 and delta_label < tol:
                     print('delta_label ', delta_label, '< tol ', tol)
                     print('Reached tolerance threshold. Stopping training.')
                     break
-            idx = index_array[index * batch_size: min((index + 1) * batch_size, X.shape[0])]
-            loss = model.train_on_batch(x=X[idx], y=p[idx])
-            index = index + 1 if (index + 1) * batch_size <= X.shape[0] else 0
+            # reshuffle at the start of every epoch, each epoch covers all the samples once
+            index = ite % batches_per_epoch
+            if index == 0:
+                np.random.shuffle(index_array)
+            idx = index_array[index * batch_size:(index + 1) * batch_size]
+            loss = train_step(idx)
 
         model.save("..\\Models\\ViT-unsupervised\\conv_DEC_model_final_cnn.h5")
 
     else:
         model = load_model("..\\Models\\ViT-unsupervised\\conv_DEC_model_final.h5")
+        # evaluate with the encoder and the centers of the loaded model, not the ones built above
+        clustering_layer.set_weights(model.get_layer(name='clustering').get_weights())
+        encoder = Model(inputs=model.input, outputs=model.get_layer(name='encoded').output, name='encoder')
+        encoder_fn = tf.function(lambda x: encoder(x, training=False), jit_compile=True)
 
     # Eval.
-    q = model.predict(X_test, verbose=0)
-    p = target_distribution(q)  # update the auxiliary target distribution p
+    # encode X_test once, both the soft assignments and the scatter plot below use Z_test
+    Z_test = predict_batched(encoder_fn, ds_test)
+    q = head_fn(Z_test)
+    p = target_distribution_tf(q)  # update the auxiliary target distribution p
 
     # evaluate the clustering performance
-    y_pred = q.argmax(1)
+    y_pred = tf.math.argmax(q, axis=1, output_type=tf.int32).numpy()
     if y is not None:
         acc_v = np.round(acc_cluster(y_test, y_pred), 5)
         nmi_v = np.round(nmi(y_test, y_pred), 5)
         ari_v = np.round(ari(y_test, y_pred), 5)
-        loss = np.round(loss, 10)
+        loss = np.round(float(loss), 10)
         print('Acc = %.5f, nmi = %.5f, ari = %.5f' % (acc_v, nmi_v, ari_v), ' ; loss=', loss)
 
-    sns.set(font_scale=3)
     confusion_matrix = confusion_matrix(y_test, y_pred)
 
     plt.figure(figsize=(16, 14))
-    sns.heatmap(confusion_matrix, annot=True, fmt="d", annot_kws={"size": 20});
+    plt.imshow(confusion_matrix, cmap='Blues')
+    plt.colorbar()
+    for (i, j), v in np.ndenumerate(confusion_matrix):
+        # white on the dark cells, as sns.heatmap did, so the matched diagonal stays readable
+        plt.text(j, i, str(v), ha='center', va='center', fontsize=20,
+                 color='white' if v > confusion_matrix.max() / 2 else 'black')
+    plt.xticks(fontsize=33)  # same size as the old sns.set(font_scale=3) ticks
+    plt.yticks(fontsize=33)
     # Here you can quickly match the clustering assignment by hand, e.g., cluster 1 matches with true label 7 or handwritten digit "7" and vise visa.
     plt.title("Confusion matrix", fontsize=30)
     plt.ylabel('True label', fontsize=25)
     plt.xlabel('Clustering label', fontsize=25)
     plt.show()
 
-    x_test_encoded = encoder.predict(X_test, batch_size=batch_size)
+    x_test_encoded = Z_test.numpy()
     plt.figure(figsize=(9, 9))
     plt.scatter(x_test_encoded[:, 0], x_test_encoded[:, 1], c=y_test)
     plt.colorbar()